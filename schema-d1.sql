@@ -17,6 +17,12 @@ CREATE TABLE companies (
     updated_at TEXT DEFAULT (datetime('now'))
 );
 
+-- Sync progress checkpoints (written by sync-d1.py, read on --resume)
+CREATE TABLE IF NOT EXISTS sync_state (
+    k TEXT PRIMARY KEY,
+    v TEXT
+);
+
 -- Create indexes for fast searching
 CREATE INDEX idx_company_name ON companies(company_name);
 CREATE INDEX idx_cin ON companies(cin);
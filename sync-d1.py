@@ -3,15 +3,60 @@ GitHub Actions Sync Script for Cloudflare D1
 Syncs 2M+ Indian companies from OGD to Cloudflare D1 Database
 """
 
+import argparse
+import gzip
+import json
+import logging
 import os
+import queue
+import random
 import requests
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+# Structured stderr logging instead of per-line stdout flushes - per-batch
+# progress is throttled so a 4000-batch run doesn't emit 20k log lines
+logger = logging.getLogger('sync')
+_handler = logging.StreamHandler(sys.stderr)
+_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+logger.addHandler(_handler)
+logger.setLevel(logging.INFO)
+
+# Log the per-batch progress line only every N batches
+LOG_EVERY_BATCHES = 10
+
+try:
+    import ijson # Streaming JSON parser - optional, falls back to response.json()
+except ImportError:
+    ijson = None
+
+try:
+    import orjson # C-extension JSON, 3-10x faster than stdlib - optional
+except ImportError:
+    orjson = None
+
+
+def _json_dumps(obj):
+    """Serialize to JSON bytes, via orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode()
+
+
+def _json_loads(data):
+    """Parse JSON from bytes/str, via orjson when available."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
 # Configuration
 CLOUDFLARE_ACCOUNT_ID = os.getenv('CLOUDFLARE_ACCOUNT_ID')
 CLOUDFLARE_API_TOKEN = os.getenv('CLOUDFLARE_API_TOKEN')
 D1_DATABASE_ID = os.getenv('D1_DATABASE_ID')
+CLOUDFLARE_KV_NAMESPACE_ID = os.getenv('CLOUDFLARE_KV_NAMESPACE_ID') # Optional: caches the running total
 OGD_API_KEY = "579b464db66ec23bdd000001374c3ea40d5040795584f9345656aee7"
 
 OGD_API_BASE = "https://api.data.gov.in/resource/"
@@ -20,58 +65,327 @@ RESOURCE_ID = "ec58dab7-d891-4abb-936e-d5d274a6ce9b"
 # D1 API endpoints
 D1_API_BASE = f"https://api.cloudflare.com/client/v4/accounts/{CLOUDFLARE_ACCOUNT_ID}/d1/database/{D1_DATABASE_ID}"
 
+# Workers KV endpoint - used as a write-through cache for the running total
+KV_API_BASE = f"https://api.cloudflare.com/client/v4/accounts/{CLOUDFLARE_ACCOUNT_ID}/storage/kv/namespaces/{CLOUDFLARE_KV_NAMESPACE_ID}"
+
+# KV key prefix for the cached company counts - one key per shard
+# (total_companies:{start_offset}) so parallel matrix jobs never clobber
+# each other's counter; the overall total is the sum across shard keys
+KV_TOTAL_KEY = 'total_companies'
+
+# Size of the full OGD dataset (2M companies) - the default offset range
+MAX_RECORDS = 2000000
+
+# Prepared once at module level so every batch sends byte-identical statement
+# text and D1's statement cache can reuse the parsed plan instead of
+# re-planning per call - always reference these constants, never rebuild the
+# SQL string per row or per batch.
+# Default skips duplicate CINs at the storage layer - INSERT OR REPLACE does a
+# full delete+insert (plus index and FTS trigger work) even when nothing changed.
+INSERT_SQL = """INSERT INTO companies
+(company_name, cin, status, registration_date, company_class, roc, email, state)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(cin) DO NOTHING"""
+
+# Used with --upsert when a refresh of existing rows is actually wanted
+UPSERT_SQL = """INSERT OR REPLACE INTO companies
+(company_name, cin, status, registration_date, company_class, roc, email, state)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)"""
+
+# Selected at startup based on --upsert
+ACTIVE_INSERT_SQL = INSERT_SQL
+
+# Statements per /batch call (Cloudflare recommends ~100-500 per batch)
+D1_BATCH_STATEMENTS = 100
+
+# Concurrent D1 insert workers - D1's REST endpoint handles parallel writes,
+# and overlapping HTTP round trips is where the throughput comes from
+D1_MAX_WORKERS = 8
+
+# Concurrent OGD page fetches per window - the producer keeps this many
+# fetches in flight at once so pages arrive faster than they are consumed
+OGD_FETCH_WORKERS = 4
+
+# Shared session so the TCP+TLS connection to api.cloudflare.com stays warm
+# across the thousands of requests this sync makes (saves 1-2 RTTs per call)
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(max_retries=0, pool_maxsize=16))
+
+# D1 headers built once - only sent to Cloudflare, never to the OGD API
+D1_HEADERS = {
+    'Authorization': f'Bearer {CLOUDFLARE_API_TOKEN}',
+    'Content-Type': 'application/json'
+}
+
+# Retry policy for transient failures (429 / 5xx / connection errors)
+MAX_RETRIES = 3
+RETRY_BASE_SECONDS = 1
+RETRY_CAP_SECONDS = 30
+
+
+class AdaptiveDelay:
+    """AIMD pacing: shrink the delay while calls succeed, double it on 429.
+
+    Replaces the old fixed 1s sleep, which was too slow when the API was
+    healthy and did nothing once it was already throttling. Thread-safe so
+    the insert workers can share one instance.
+    """
 
-print("D1_API_BASE ", D1_API_BASE )
-print("CLOUDFLARE_API_TOKEN ", CLOUDFLARE_API_TOKEN )
-print("CLOUDFLARE_ACCOUNT_ID ", CLOUDFLARE_ACCOUNT_ID )
-print("D1_DATABASE_ID ", D1_DATABASE_ID )
-print("OGD_API_KEY ", OGD_API_KEY )
+    def __init__(self, initial=0.2, floor=0.05, ceiling=5.0):
+        self.delay = initial
+        self.floor = floor
+        self.ceiling = ceiling
+        self._consecutive_ok = 0
+        self._lock = threading.Lock()
 
+    def on_success(self):
+        with self._lock:
+            self._consecutive_ok += 1
+            if self._consecutive_ok > 5:
+                self.delay = max(self.floor, self.delay * 0.9)
 
-def execute_d1_query(sql, params=None):
-    """Execute SQL query on D1 database via Cloudflare API"""
-    # Check if essential secrets are missing (can happen if GitHub secret is wrong)
-    if not CLOUDFLARE_API_TOKEN or not CLOUDFLARE_ACCOUNT_ID or not D1_DATABASE_ID:
-         print("❌ Error: Cloudflare API Token, Account ID, or D1 Database ID is missing. Check GitHub Secrets.")
-         return None
+    def on_throttle(self):
+        with self._lock:
+            self.delay = min(self.ceiling, self.delay * 2)
+            self._consecutive_ok = 0
 
-    headers = {
-        'Authorization': f'Bearer {CLOUDFLARE_API_TOKEN}',
-        'Content-Type': 'application/json'
-    }
+    def wait(self):
+        time.sleep(self.delay)
+
+
+# Independent pacers for the two APIs - their rate limits are unrelated
+OGD_PACER = AdaptiveDelay()
+D1_PACER = AdaptiveDelay()
 
-    payload = {
-        'sql': sql
+# Running count of in-batch duplicate CINs dropped, reported in the
+# completion summary (incremented from insert worker threads, hence the lock)
+_duplicates_lock = threading.Lock()
+_duplicates_dropped = 0
+
+# Candidate batch sizes tried during warm-up, smallest first
+BATCH_SIZE_CANDIDATES = [100, 250, 500, 1000, 2000]
+
+# Stay well under D1's ~10MB request payload cap
+MAX_BATCH_PAYLOAD_BYTES = 8 * 1024 * 1024
+
+# Only gzip request bodies above this size - for small queries (the startup
+# checks, checkpoints) compression is pure overhead
+GZIP_MIN_BYTES = 4096
+
+# (connect, read) timeouts: connect fails fast (5s) so the retry helper can
+# kick in instead of hanging on a dead connection, reads stay generous
+D1_TIMEOUT = (5, 55)
+OGD_TIMEOUT = (5, 25)
+KV_TIMEOUT = (5, 25)
+
+
+def _request_with_retry(method, url, pacer=None, **kwargs):
+    """Send a request, retrying transient failures with full-jitter backoff.
+
+    429s, 5xx responses, connection errors and timeouts are retried up to
+    MAX_RETRIES times, sleeping random() * min(cap, base * 2**attempt)
+    between attempts (or honoring a Retry-After header when the server sends
+    one). Other 4xx responses are returned immediately - retrying won't help.
+    """
+    last_exc = None
+    response = None
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = SESSION.request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            last_exc = e
+            response = None
+
+        if response is not None and response.status_code != 429 and response.status_code < 500:
+            if pacer is not None:
+                pacer.on_success()
+            return response # Success (or an unrecoverable 4xx the caller handles)
+
+        if pacer is not None and response is not None and response.status_code == 429:
+            pacer.on_throttle() # Tell the pacer to slow the whole pipeline down
+
+        if attempt == MAX_RETRIES:
+            break # Out of retries, fall through with whatever we have
+
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            wait = int(retry_after)
+        else:
+            wait = random.random() * min(RETRY_CAP_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt)
+        time.sleep(wait)
+
+    if response is None:
+        raise last_exc # Every attempt died before getting a response
+    return response
+
+
+def _validate_env():
+    """Fail fast on missing configuration without ever logging the values."""
+    required = {
+        'CLOUDFLARE_ACCOUNT_ID': CLOUDFLARE_ACCOUNT_ID,
+        'CLOUDFLARE_API_TOKEN': CLOUDFLARE_API_TOKEN,
+        'D1_DATABASE_ID': D1_DATABASE_ID,
+        'OGD_API_KEY': OGD_API_KEY,
     }
+    missing = [name for name, value in required.items() if not value]
+    if missing:
+        sys.exit(f"Missing required configuration: {', '.join(missing)}. Check GitHub Secrets.")
+
+
+def execute_d1_query(sql=None, params=None, statements=None):
+    """Execute SQL on D1 via the Cloudflare API.
+
+    Pass `sql` (and optional `params`) for a single query, or `statements`
+    (a list of {'sql': ..., 'params': [...]} dicts) to hit the /batch
+    endpoint, which runs all statements in one round trip.
+    """
+    # Check if essential secrets are missing (can happen if GitHub secret is wrong)
+    if not CLOUDFLARE_API_TOKEN or not CLOUDFLARE_ACCOUNT_ID or not D1_DATABASE_ID:
+         logger.error("Cloudflare API Token, Account ID, or D1 Database ID is missing. Check GitHub Secrets.")
+         return None
 
-    if params:
-        payload['params'] = params
+    if statements is not None:
+        url = f"{D1_API_BASE}/batch"
+        payload = statements
+    else:
+        url = f"{D1_API_BASE}/query"
+        payload = {'sql': sql}
+        if params:
+            payload['params'] = params
+
+    # Batch insert bodies are mostly repeated field names and compressible
+    # company strings - gzip cuts upload bytes ~4-6x on asymmetric CI links
+    body = _json_dumps(payload)
+    headers = D1_HEADERS
+    if len(body) > GZIP_MIN_BYTES:
+        body = gzip.compress(body)
+        headers = dict(D1_HEADERS, **{'Content-Encoding': 'gzip'})
 
     try:
-        response = requests.post(
-            f"{D1_API_BASE}/query",
+        response = _request_with_retry(
+            'POST',
+            url,
+            pacer=D1_PACER,
             headers=headers,
-            json=payload,
-            timeout=60 # Increased timeout for potentially long inserts
+            data=body,
+            timeout=D1_TIMEOUT # Generous read timeout for potentially long inserts
         )
         response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-        return response.json()
+        return _json_loads(response.content)
 
     except requests.exceptions.RequestException as e:
-        print(f"❌ D1 Query Request Error: {e}")
-        # Attempt to print more details from the response if available
+        logger.error(f"D1 Query Request Error: {e}")
+        # Attempt to log more details from the response if available
         try:
-             print(f"   Response Status: {e.response.status_code}")
-             print(f"   Response Text: {e.response.text}")
+             logger.error(f"Response Status: {e.response.status_code} | Response Text: {e.response.text}")
         except AttributeError:
              pass # No response object available
         return None
 
+def load_checkpoint(shard_key):
+    """Read the last saved (offset, total) for one shard from sync_state.
+
+    Checkpoint keys are namespaced by the shard's start offset so parallel
+    matrix jobs don't clobber each other. Returns None when no checkpoint
+    exists yet or it can't be parsed.
+    """
+    result = execute_d1_query("SELECT k, v FROM sync_state")
+    if not result or not result.get('success', False):
+        return None
+    try:
+        state = {row['k']: row['v'] for row in result.get('result', [{}])[0].get('results', [])}
+        return int(state[f'offset:{shard_key}']), int(state[f'total:{shard_key}'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def save_checkpoint(offset, total, shard_key):
+    """Persist sync progress so a crashed run can --resume from here instead
+    of re-fetching (and re-inserting) the whole shard."""
+    execute_d1_query(
+        "INSERT OR REPLACE INTO sync_state (k, v) VALUES (?, ?), (?, ?)",
+        params=[f'offset:{shard_key}', str(offset), f'total:{shard_key}', str(total)]
+    )
+
+
+def kv_get(key):
+    """Read a value from Workers KV. Returns None when KV is not configured,
+    the key is missing, or the read fails - callers fall back to D1."""
+    if not CLOUDFLARE_KV_NAMESPACE_ID:
+        return None
+
+    try:
+        response = _request_with_retry(
+            'GET',
+            f"{KV_API_BASE}/values/{key}",
+            headers={'Authorization': f'Bearer {CLOUDFLARE_API_TOKEN}'},
+            timeout=KV_TIMEOUT
+        )
+        if response.status_code == 200:
+            return response.text
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"KV read failed for '{key}': {e}")
+    return None
+
+
+def kv_put(key, value):
+    """Write a value through to Workers KV. Best-effort: the sync never
+    fails because the cache couldn't be updated."""
+    if not CLOUDFLARE_KV_NAMESPACE_ID:
+        return
+
+    try:
+        _request_with_retry(
+            'PUT',
+            f"{KV_API_BASE}/values/{key}",
+            headers={'Authorization': f'Bearer {CLOUDFLARE_API_TOKEN}'},
+            data=str(value),
+            timeout=KV_TIMEOUT
+        )
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"KV write failed for '{key}': {e}")
+
+
+def kv_total_companies():
+    """Sum the per-shard KV counters into an overall company count.
+
+    Returns None when KV is not configured, no shard counters exist yet, or
+    the key listing fails - callers fall back to D1.
+    """
+    if not CLOUDFLARE_KV_NAMESPACE_ID:
+        return None
+
+    try:
+        response = _request_with_retry(
+            'GET',
+            f"{KV_API_BASE}/keys",
+            headers={'Authorization': f'Bearer {CLOUDFLARE_API_TOKEN}'},
+            params={'prefix': f'{KV_TOTAL_KEY}:'},
+            timeout=KV_TIMEOUT
+        )
+        if response.status_code != 200:
+            return None
+        keys = [k['name'] for k in _json_loads(response.content).get('result', [])]
+    except requests.exceptions.RequestException as e:
+        logger.warning(f"KV key listing failed: {e}")
+        return None
+
+    if not keys:
+        return None
+
+    total = 0
+    for name in keys:
+        value = kv_get(name)
+        if value is not None and value.strip().isdigit():
+            total += int(value.strip())
+    return total
+
+
 def sync_companies_batch(offset, limit=1000):
     """Fetch batch of companies from OGD API"""
     # Check if OGD API Key is missing
     if not OGD_API_KEY:
-        print("❌ Error: OGD_API_KEY is missing. Check GitHub Secret.")
+        logger.error("OGD_API_KEY is missing. Check GitHub Secret.")
         return []
 
     params = {
@@ -82,190 +396,407 @@ def sync_companies_batch(offset, limit=1000):
     }
 
     try:
-        response = requests.get(
+        response = _request_with_retry(
+            'GET',
             f"{OGD_API_BASE}{RESOURCE_ID}",
+            pacer=OGD_PACER,
             params=params,
-            timeout=30
+            timeout=OGD_TIMEOUT,
+            stream=True
         )
         response.raise_for_status() # Raise HTTPError for bad responses
 
-        data = response.json()
+        if ijson is not None:
+            # Stream-parse the records array straight off the socket so the
+            # full response text is never resident alongside the parsed dicts
+            response.raw.decode_content = True # Let urllib3 un-gzip the stream
+            return list(ijson.items(response.raw, 'records.item'))
+
+        data = _json_loads(response.content)
         return data.get('records', [])
 
     except requests.exceptions.RequestException as e:
-        print(f"❌ OGD API Request Error: {e}")
+        logger.error(f"OGD API Request Error: {e}")
         try:
-             print(f"   Response Status: {e.response.status_code}")
-             print(f"   Response Text: {e.response.text}")
+             logger.error(f"Response Status: {e.response.status_code} | Response Text: {e.response.text}")
         except AttributeError:
              pass
         return [] # Return empty list on error
     except Exception as e:
-        print(f"❌ Error fetching or parsing OGD data: {str(e)}")
+        logger.error(f"Error fetching or parsing OGD data: {str(e)}")
         return []
 
 def insert_companies_batch(companies):
-    """Insert batch of companies into D1"""
+    """Insert batch of companies into D1.
+
+    Each /batch call executes its statements inside a single implicit
+    transaction on D1's side, so a chunk of D1_BATCH_STATEMENTS rows commits
+    (and fsyncs) once rather than per-row - and either lands entirely or not
+    at all if a statement fails.
+    """
     if not companies:
         return 0 # Return 0 if no companies to insert
 
-    values = []
-    for company in companies:
-        # Use .get() with default None to handle missing keys gracefully
-        cin = company.get('corporate_identification_number')
-        if not cin:
-            # print("Skipping record with missing CIN") # Optional: uncomment for debugging
-            continue # Skip records without a CIN
-
-        # Use lowercase keys and provide empty string defaults
-        name = company.get('company_name', '').replace("'", "''")
-        status = company.get('company_status', '').replace("'", "''")
-        reg_date = company.get('date_of_registration', '').replace("'", "''") # Check format if errors occur
-        company_class = company.get('company_class', '').replace("'", "''")
-        roc = company.get('registrar_of_companies', '').replace("'", "''")
-        # Check API response for the correct email key ('email_id' or 'email')
-        email = company.get('email_id', company.get('email', '')).replace("'", "''")
-        # Check API response for the correct state key ('registered_state' or 'state')
-        state = company.get('registered_state', company.get('state', '')).replace("'", "''")
-
-        # Basic validation/sanitization (can be expanded)
-        if len(cin) > 50: cin = cin[:50] # Example: truncate long CINs if needed
-        if len(name) > 255: name = name[:255] # Example: truncate long names
-
-        values.append(f"('{name}', '{cin}', '{status}', '{reg_date}', '{company_class}', '{roc}', '{email}', '{state}')")
-
-    if not values:
-        print("ℹ️ No valid company records found in the current batch to insert.")
+    # Bound parameters - D1 handles quoting, no manual escaping needed
+    rows = [row for row in map(_row_from_company, companies) if row is not None]
+
+    if not rows:
+        logger.info("No valid company records found in the current batch to insert.")
         return 0 # Return 0 if all records were skipped
 
-    # Build the potentially very long SQL string
-    sql = f"""
-    INSERT OR REPLACE INTO companies
-    (company_name, cin, status, registration_date, company_class, roc, email, state)
-    VALUES {', '.join(values)}
+    # Deduplicate by CIN - OGD pages repeat CINs, and each duplicate burns a
+    # statement slot and a pointless conflict check in D1. Keyed by CIN
+    # (row[1]) so the last-seen record wins, closest to "latest" semantics.
+    deduped = {row[1]: row for row in rows}
+    duplicate_count = len(rows) - len(deduped)
+    if duplicate_count:
+        global _duplicates_dropped
+        with _duplicates_lock:
+            _duplicates_dropped += duplicate_count
+        logger.debug(f"Dropped {duplicate_count} duplicate CIN(s) within this batch")
+
+    stmts = [{'sql': ACTIVE_INSERT_SQL, 'params': row} for row in deduped.values()]
+
+    # Send statements to the /batch endpoint in chunks, summing rows_written
+    rows_written = 0
+    for i in range(0, len(stmts), D1_BATCH_STATEMENTS):
+        if i > 0:
+            D1_PACER.wait() # Adaptive spacing between /batch calls
+        chunk = stmts[i:i + D1_BATCH_STATEMENTS]
+        result = execute_d1_query(statements=chunk)
+
+        if result and result.get('success', False):
+            # Each statement in the batch returns its own meta
+            for stmt_result in result.get('result', []):
+                rows_written += stmt_result.get('meta', {}).get('rows_written', 1)
+        else:
+            logger.error(f"Failed to insert batch chunk. D1 Result: {result}")
+
+    return rows_written
+
+# Alternative key names seen in OGD responses for the same field
+EMAIL_KEYS = ('email_id', 'email')
+STATE_KEYS = ('registered_state', 'state')
+
+
+def _row_from_company(company):
+    """Extract one INSERT_SQL parameter tuple from an OGD record.
+
+    Returns None for records without a CIN - those are skipped. Field order
+    matches the column list in INSERT_SQL.
     """
+    cin = company.get('corporate_identification_number')
+    if not cin:
+        return None
 
-    # Execute the query
-    result = execute_d1_query(sql)
+    name = company.get('company_name', '')
+
+    # Basic validation/sanitization (can be expanded)
+    if len(cin) > 50: cin = cin[:50] # Example: truncate long CINs if needed
+    if len(name) > 255: name = name[:255] # Example: truncate long names
+
+    return (
+        name,
+        cin,
+        company.get('company_status', ''),
+        company.get('date_of_registration', ''),
+        company.get('company_class', ''),
+        company.get('registrar_of_companies', ''),
+        next((company[k] for k in EMAIL_KEYS if company.get(k)), ''),
+        next((company[k] for k in STATE_KEYS if company.get(k)), ''),
+    )
+
+
+def tune_batch_size(start_offset, end_offset):
+    """Warm-up phase: measure insert throughput at each candidate batch size.
+
+    Fetches and inserts one batch per candidate (never past end_offset,
+    this job's shard bound), timing the insert with time.perf_counter(),
+    and keeps the fastest in rows/sec. Returns (best_size, next_offset,
+    rows_inserted) so the warm-up batches still count toward the sync
+    instead of being thrown away.
+    """
+    best_size = BATCH_SIZE_CANDIDATES[0]
+    best_rate = 0.0
+    offset = start_offset
+    total_inserted = 0
+
+    for size in BATCH_SIZE_CANDIDATES:
+        # Clamp to the shard bound - a resumed run can start near it
+        limit = min(size, end_offset - offset)
+        if limit <= 0:
+            break # Shard already exhausted
+
+        companies = sync_companies_batch(offset, limit)
+        if not companies:
+            break # Already at end of data - tuning is moot
+
+        # Payload guard: estimate serialized batch size from the first row and
+        # stop before a candidate would blow past the cap (candidates ascend)
+        row_bytes = sum(len(str(v)) for v in companies[0].values())
+        if row_bytes * size > MAX_BATCH_PAYLOAD_BYTES:
+            logger.info(f"Skipping batch size {size}+: estimated payload exceeds {MAX_BATCH_PAYLOAD_BYTES // (1024 * 1024)}MB cap")
+            break
+
+        started = time.perf_counter()
+        inserted = insert_companies_batch(companies)
+        elapsed = time.perf_counter() - started
+
+        offset += len(companies)
+        total_inserted += inserted
+
+        rate = inserted / elapsed if elapsed > 0 else 0.0
+        logger.info(f"Batch size {size}: {rate:,.0f} rows/sec")
+        if rate > best_rate:
+            best_rate = rate
+            best_size = size
+
+        if len(companies) < limit:
+            break # Ran out of data mid warm-up
+
+    return best_size, offset, total_inserted
+
+
+def fetch_producer(fetch_queue, start_offset, batch_size, end_offset, errors):
+    """Producer thread: fetch OGD batches ahead of the D1 insert stage.
+
+    Keeps OGD_FETCH_WORKERS page fetches in flight at once (a window) and
+    hands completed pages to the consumer in offset order, so both the fetch
+    and insert stages stay busy. Fetches [start_offset, end_offset) - this
+    job's shard. Puts (offset, companies) tuples on the queue and a None
+    sentinel when there is no more data (or on error).
+    """
+    offset = start_offset
+    try:
+        with ThreadPoolExecutor(max_workers=OGD_FETCH_WORKERS) as fetch_pool:
+            done = False
+            while not done and offset < end_offset:
+                # Launch a window of page fetches in parallel
+                window = []
+                for _ in range(OGD_FETCH_WORKERS):
+                    if offset >= end_offset:
+                        break
+                    # Clamp the last page so this shard never fetches past its bound
+                    limit = min(batch_size, end_offset - offset)
+                    window.append((offset, limit, fetch_pool.submit(sync_companies_batch, offset, limit)))
+                    offset += limit
+
+                # Hand pages over in offset order as they complete
+                for page_offset, limit, future in window:
+                    companies = future.result()
+                    fetch_queue.put((page_offset, companies))
+
+                    # Empty or short page means end of data - stop fetching
+                    if not companies or len(companies) < limit:
+                        done = True
+                        break
+
+                # Adaptive rate limiting (be nice to the OGD API) - only the
+                # fetch stage waits, the insert stage runs while we sleep
+                OGD_PACER.wait()
+    except Exception as e:
+        errors.append(e)
+    finally:
+        fetch_queue.put(None) # Sentinel: no more batches coming
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Sync OGD company data into Cloudflare D1')
+    parser.add_argument('--stats', action='store_true',
+                        help='Run the full COUNT(*) statistics query against D1 at the end (slow on 2M rows)')
+    parser.add_argument('--resume', action='store_true',
+                        help='Resume from the offset checkpointed in the sync_state table')
+    parser.add_argument('--upsert', action='store_true',
+                        help='Replace existing rows on duplicate CIN instead of skipping them')
+    # Shard bounds default from env so the Actions matrix can set them
+    parser.add_argument('--start-offset', type=int,
+                        default=int(os.getenv('SYNC_START_OFFSET', '0')),
+                        help='First OGD record offset this job syncs (inclusive)')
+    parser.add_argument('--end-offset', type=int,
+                        default=int(os.getenv('SYNC_END_OFFSET', str(MAX_RECORDS))),
+                        help='Offset at which this job stops fetching (exclusive)')
+    return parser.parse_args()
 
-    # Check the result and return the count OR 0 on failure
-    if result and result.get('success', False):
-        # D1 success response might contain metadata about changes
-        meta = result.get('result', [{}])[0].get('meta', {})
-        rows_written = meta.get('rows_written', len(values)) # Use rows_written if available, else assume all succeeded
-        # print(f"D1 Meta: {meta}") # Optional: uncomment for debugging
-        return rows_written
-    else:
-        print(f"❌ Failed to insert batch. D1 Result: {result}")
-        return 0 # *** THIS IS THE FIX for the TypeError ***
 
 def main():
+    global ACTIVE_INSERT_SQL
+
+    args = parse_args()
+    _validate_env()
+    if args.upsert:
+        ACTIVE_INSERT_SQL = UPSERT_SQL
+
     print("=" * 60)
     print("Cloudflare D1 Company Data Sync")
     print("=" * 60)
     print(f"Started at: {datetime.utcnow()}")
     print()
 
-    # Check if database is accessible
-    print("✓ Checking D1 database connection...")
-    test_result = execute_d1_query("SELECT COUNT(*) as count FROM companies")
-    if test_result:
-        try:
-            # Safely access nested data
-            count = test_result.get('result', [{}])[0].get('results', [{}])[0].get('count', 'N/A')
-            print(f"✓ Database connected. Current companies: {count}")
-        except (IndexError, KeyError, TypeError):
-             print(f"✓ Database connected, but couldn't parse count. Response: {test_result}")
+    # Overall total comes from the per-shard KV counters when available -
+    # a COUNT(*) over a 2M-row D1 table is a multi-second full scan
+    kv_overall = kv_total_companies()
+    if kv_overall is not None:
+        logger.info(f"Current companies (from KV counters): {kv_overall:,}")
     else:
-        print("❌ Database connection failed!")
-        return # Exit if connection fails
-
-    # Sync companies in batches
+        # KV unset or unavailable - fall back to D1 (also doubles as a connection check)
+        logger.info("Checking D1 database connection...")
+        test_result = execute_d1_query("SELECT COUNT(*) as count FROM companies")
+        if test_result:
+            try:
+                # Safely access nested data
+                count = test_result.get('result', [{}])[0].get('results', [{}])[0].get('count', 'N/A')
+                logger.info(f"Database connected. Current companies: {count}")
+            except (IndexError, KeyError, TypeError):
+                 logger.warning(f"Database connected, but couldn't parse count. Response: {test_result}")
+        else:
+            logger.error("Database connection failed!")
+            return # Exit if connection fails
+
+    # Make sure the checkpoint table exists (idempotent, cheap)
+    execute_d1_query("CREATE TABLE IF NOT EXISTS sync_state (k TEXT PRIMARY KEY, v TEXT)")
+
+    # ON CONFLICT(cin) needs a unique index - the schema declares cin UNIQUE,
+    # but guard older deployments with an idempotent migration
+    execute_d1_query("CREATE UNIQUE INDEX IF NOT EXISTS idx_companies_cin ON companies(cin)")
+
+    # Sync companies in batches within this job's offset shard
     total_synced = 0
-    offset = 0
-    batch_size = 500 # Reduced batch size to potentially avoid "SQL too long" errors
-    max_records = 2000000 # 2M companies
-
-    print()
-    print(f"Starting sync... (Target: {max_records:,} companies, Batch Size: {batch_size})")
-    print()
+    offset = args.start_offset
+    end_offset = args.end_offset
+    shard_key = args.start_offset # Namespaces checkpoints across matrix shards
+    target_records = end_offset - offset
+
+    if args.resume:
+        checkpoint = load_checkpoint(shard_key)
+        if checkpoint:
+            offset, total_synced = checkpoint
+            logger.info(f"Resuming from checkpoint: offset {offset:,} ({total_synced:,} rows already synced)")
+        else:
+            logger.info(f"--resume requested but no checkpoint found, starting from offset {shard_key:,}")
+
+    # This shard's own KV counter - written through after every drained batch
+    shard_total_key = f"{KV_TOTAL_KEY}:{shard_key}"
+    shard_kv = kv_get(shard_total_key)
+    shard_base = int(shard_kv.strip()) if shard_kv is not None and shard_kv.strip().isdigit() else 0
+    if args.resume and total_synced:
+        # The crashed run already wrote the checkpointed rows into the shard
+        # counter - rebase so they aren't counted twice
+        shard_base = max(0, shard_base - total_synced)
+
+    # Warm-up: discover the best batch size instead of guessing (the old
+    # hardcoded 500 was a workaround for SQL string length limits that no
+    # longer apply with the /batch endpoint)
+    logger.info("Tuning batch size...")
+    batch_size, offset, warmed_up = tune_batch_size(offset, end_offset)
+    total_synced += warmed_up
+    save_checkpoint(offset, total_synced, shard_key)
+    logger.info(f"Selected batch size: {batch_size} (warm-up synced {warmed_up:,} rows)")
+
+    logger.info(f"Starting sync... (Offsets: {args.start_offset:,}-{end_offset:,}, Batch Size: {batch_size})")
+
+    # Pipeline: a producer thread fetches from OGD while we insert into D1.
+    # The bounded queue keeps the fetcher a limited number of batches ahead.
+    fetch_queue = queue.Queue(maxsize=OGD_FETCH_WORKERS * 2)
+    producer_errors = []
+    producer = threading.Thread(
+        target=fetch_producer,
+        args=(fetch_queue, offset, batch_size, end_offset, producer_errors),
+        daemon=True
+    )
+    producer.start()
+
+    # Several inserts stay in flight at once; futures are drained oldest-first
+    # so the running total stays in batch order.
+    executor = ThreadPoolExecutor(max_workers=D1_MAX_WORKERS)
+    futures = [] # List of (batch_num, next_offset, future), in submission order
+
+    def drain_oldest_insert():
+        nonlocal total_synced
+        done_batch_num, next_offset, future = futures.pop(0)
+        inserted = future.result()
+        total_synced += inserted
+        kv_put(shard_total_key, shard_base + total_synced) # Write-through this shard's counter
+        save_checkpoint(next_offset, total_synced, shard_key) # Crash now costs at most the in-flight batches
+        # Throttled progress line - one per LOG_EVERY_BATCHES, not per batch
+        if done_batch_num % LOG_EVERY_BATCHES == 0:
+            logger.info(f"Inserted in batch {done_batch_num}: {inserted} | Total Synced: {total_synced:,}")
+
+    while total_synced < target_records:
+        item = fetch_queue.get()
+
+        if item is None: # Sentinel: producer is done (end of data or error)
+            if producer_errors:
+                logger.error(f"Error fetching batch, stopping sync: {producer_errors[0]}")
+            break
 
-    while total_synced < max_records:
+        offset, companies = item
         batch_num = offset // batch_size + 1
-        print(f"📥 Fetching batch {batch_num}... (Offset: {offset:,})")
-
-        # Fetch batch from OGD
-        companies = sync_companies_batch(offset, batch_size)
-
-        if companies is None: # Handle case where sync_companies_batch had an error and returned None explicitly
-             print("❌ Error fetching batch, stopping sync.")
-             break
 
         if not companies:
             # Check if this is the first batch or not
-            if offset == 0:
-                 print("❌ No records received from OGD API on the first batch. Check API Key and Resource ID.")
+            if offset == args.start_offset:
+                 logger.error("No records received from OGD API on the first batch. Check API Key and Resource ID.")
             else:
-                 print("✓ No more records available from OGD or end of data reached.")
+                 logger.info("No more records available from OGD or end of data reached.")
             break # Exit the loop
 
-        # Insert into D1
-        print(f"💾 Inserting {len(companies)} fetched companies into D1...")
-        inserted = insert_companies_batch(companies)
-
-        # inserted should now always be an int (0 on failure)
-        if inserted is None: # Should not happen now, but good to check
-             print("❌ Insert function returned None unexpectedly. Stopping sync.")
-             inserted = 0 # Treat as 0 inserted for safety
-             break
-
-        total_synced += inserted
+        # Submit insert to the pool (fetch for the next batch is already in flight)
+        logger.debug(f"Inserting {len(companies)} fetched companies into D1... (Batch {batch_num}, Offset: {offset:,})")
+        futures.append((batch_num, offset + len(companies), executor.submit(insert_companies_batch, companies)))
 
-        print(f"✓ Inserted in batch {batch_num}: {inserted} | Total Synced: {total_synced:,}")
-        print()
+        # Cap in-flight work: once the pool is full, block on the oldest insert
+        if len(futures) >= D1_MAX_WORKERS:
+            drain_oldest_insert()
 
-        # Check if we got fewer records than requested (means end of data)
+        # Check if we got fewer records than requested (means the end of the
+        # shard range, or of the data itself)
         if len(companies) < batch_size:
-            print("✓ Reached end of available data (received fewer records than batch size).")
+            logger.info("Reached end of shard range or available data (received fewer records than batch size).")
             break
 
-        offset += batch_size
-
-        # Rate limiting (be nice to APIs)
-        time.sleep(1) # Slightly reduced sleep time
-
-        # Safety break if something goes wrong and offset increases indefinitely
-        if batch_num > (max_records / batch_size) + 100: # Allow some extra loops
-             print("❌ Safety break: Exceeded expected number of batches. Stopping sync.")
-             break
-
         # Stop if we've reached our target
-        if total_synced >= max_records:
-            print(f"✓ Reached target of {max_records:,} companies")
+        if total_synced >= target_records:
+            logger.info(f"Reached target of {target_records:,} companies for this shard")
             break
 
+    # Wait for any inserts still in flight before reporting totals
+    while futures:
+        drain_oldest_insert()
+    executor.shutdown(wait=True)
+
+    producer.join(timeout=5) # Producer is a daemon, so a stuck fetch won't hang exit
+
     # Get final statistics
     print()
     print("=" * 60)
     print("Sync Complete!")
     print("=" * 60)
-
-    stats_result = execute_d1_query("""
-        SELECT
-            COUNT(*) as total,
-            COUNT(CASE WHEN status = 'Active' THEN 1 END) as active
-        FROM companies
-    """)
-
-    if stats_result and stats_result.get('success', False):
-         try:
-            stats = stats_result.get('result', [{}])[0].get('results', [{}])[0]
-            print(f"Total companies in D1: {stats.get('total', 'N/A'):,}")
-            print(f"Active companies in D1: {stats.get('active', 'N/A'):,}")
-         except (IndexError, KeyError, TypeError):
-             print(f"✓ Sync finished, but couldn't parse final stats. Response: {stats_result}")
+    print(f"Duplicate CINs dropped in-batch: {_duplicates_dropped:,}")
+
+    if args.stats:
+        # Exact counts straight from D1 - full scans, so opt-in only
+        stats_result = execute_d1_query("""
+            SELECT
+                COUNT(*) as total,
+                COUNT(CASE WHEN status = 'Active' THEN 1 END) as active
+            FROM companies
+        """)
+
+        if stats_result and stats_result.get('success', False):
+             try:
+                stats = stats_result.get('result', [{}])[0].get('results', [{}])[0]
+                print(f"Total companies in D1: {stats.get('total', 'N/A'):,}")
+                print(f"Active companies in D1: {stats.get('active', 'N/A'):,}")
+             except (IndexError, KeyError, TypeError):
+                 logger.warning(f"Sync finished, but couldn't parse final stats. Response: {stats_result}")
+        else:
+             logger.error("Could not fetch final statistics from D1.")
     else:
-         print("❌ Could not fetch final statistics from D1.")
+        kv_overall = kv_total_companies()
+        if kv_overall is not None:
+            print(f"Total companies (KV counters, all shards): {kv_overall:,}")
+        print(f"Rows written by this job: {total_synced:,}")
+        print("(run with --stats for exact counts from D1)")
 
     print(f"Completed at: {datetime.utcnow()}")
     print("=" * 60)